@@ -1,12 +1,19 @@
 # populate_db.py
 # Migrate Code-1 normalized SQLite DB -> Postgres (Code-2 style script structure)
 
+import csv
+import functools
+import io
+import queue
 import sqlite3
+import sys
 import datetime
+import threading
+from itertools import islice
 from pathlib import Path
 
 import psycopg2
-from psycopg2 import extras
+from psycopg2 import errors, extras
 
 from utils import get_db_url
 
@@ -38,61 +45,184 @@ DROP TABLE IF EXISTS country CASCADE;
 DROP TABLE IF EXISTS region CASCADE;
 
 -- Recreate Code 1 schema (IDs preserved from SQLite, so NOT SERIAL)
-CREATE TABLE region (
+-- Foreign keys are added after the bulk load (POSTGRES_FOREIGN_KEYS_SQL)
+-- UNLOGGED during the load; switched to LOGGED afterwards (POSTGRES_SET_LOGGED_SQL)
+CREATE UNLOGGED TABLE region (
     region_id INTEGER PRIMARY KEY,
     region    TEXT NOT NULL
 );
 
-CREATE TABLE country (
+CREATE UNLOGGED TABLE country (
     country_id INTEGER PRIMARY KEY,
     country    TEXT NOT NULL,
-    region_id  INTEGER NOT NULL REFERENCES region(region_id)
+    region_id  INTEGER NOT NULL
 );
 
-CREATE TABLE customer (
+CREATE UNLOGGED TABLE customer (
     customer_id INTEGER PRIMARY KEY,
     first_name  TEXT NOT NULL,
     last_name   TEXT NOT NULL,
     address     TEXT NOT NULL,
     city        TEXT NOT NULL,
-    country_id  INTEGER NOT NULL REFERENCES country(country_id)
+    country_id  INTEGER NOT NULL
 );
 
-CREATE TABLE product_category (
+CREATE UNLOGGED TABLE product_category (
     product_category_id INTEGER PRIMARY KEY,
     product_category    TEXT NOT NULL,
     product_category_description TEXT NOT NULL
 );
 
-CREATE TABLE product (
+CREATE UNLOGGED TABLE product (
     product_id INTEGER PRIMARY KEY,
     product_name TEXT NOT NULL,
     product_unit_price NUMERIC(12,2) NOT NULL,
-    product_category_id INTEGER NOT NULL REFERENCES product_category(product_category_id)
+    product_category_id INTEGER NOT NULL
 );
 
-CREATE TABLE order_detail (
+CREATE UNLOGGED TABLE order_detail (
     order_id INTEGER PRIMARY KEY,
-    customer_id INTEGER NOT NULL REFERENCES customer(customer_id),
-    product_id  INTEGER NOT NULL REFERENCES product(product_id),
+    customer_id INTEGER NOT NULL,
+    product_id  INTEGER NOT NULL,
     order_date  DATE NOT NULL,
     quantity_ordered INTEGER NOT NULL
 );
 """
 
 
+# One WAL-logged rewrite per table once the load is done, instead of WAL for every row
+POSTGRES_SET_LOGGED_SQL = """
+ALTER TABLE region SET LOGGED;
+ALTER TABLE country SET LOGGED;
+ALTER TABLE customer SET LOGGED;
+ALTER TABLE product_category SET LOGGED;
+ALTER TABLE product SET LOGGED;
+ALTER TABLE order_detail SET LOGGED;
+"""
+
+
+# Added once all rows are loaded: one set-based validation per FK
+# instead of an index probe per inserted row
+POSTGRES_FOREIGN_KEYS_SQL = """
+ALTER TABLE country
+    ADD CONSTRAINT country_region_id_fkey
+    FOREIGN KEY (region_id) REFERENCES region(region_id);
+
+ALTER TABLE customer
+    ADD CONSTRAINT customer_country_id_fkey
+    FOREIGN KEY (country_id) REFERENCES country(country_id);
+
+ALTER TABLE product
+    ADD CONSTRAINT product_product_category_id_fkey
+    FOREIGN KEY (product_category_id) REFERENCES product_category(product_category_id);
+
+ALTER TABLE order_detail
+    ADD CONSTRAINT order_detail_customer_id_fkey
+    FOREIGN KEY (customer_id) REFERENCES customer(customer_id);
+
+ALTER TABLE order_detail
+    ADD CONSTRAINT order_detail_product_id_fkey
+    FOREIGN KEY (product_id) REFERENCES product(product_id);
+"""
+
+
+# Pre-aggregated results for the app's Quick Prompts (PRESET_SQL in streamlit_app.py).
+# Each view has a unique index so it can be refreshed CONCURRENTLY
+POSTGRES_MATERIALIZED_VIEWS_SQL = """
+DROP MATERIALIZED VIEW IF EXISTS mv_revenue_by_region;
+DROP MATERIALIZED VIEW IF EXISTS mv_customer_spend;
+DROP MATERIALIZED VIEW IF EXISTS mv_monthly_sales;
+DROP MATERIALIZED VIEW IF EXISTS mv_product_revenue;
+DROP MATERIALIZED VIEW IF EXISTS mv_revenue_by_category;
+
+CREATE MATERIALIZED VIEW mv_revenue_by_region AS
+SELECT r.region AS region,
+       ROUND(SUM(p.product_unit_price * od.quantity_ordered), 2) AS total_revenue
+FROM order_detail od
+JOIN product p ON p.product_id = od.product_id
+JOIN customer c ON c.customer_id = od.customer_id
+JOIN country co ON co.country_id = c.country_id
+JOIN region r ON r.region_id = co.region_id
+GROUP BY r.region;
+CREATE UNIQUE INDEX ON mv_revenue_by_region (region);
+CREATE INDEX ON mv_revenue_by_region (total_revenue DESC);
+
+CREATE MATERIALIZED VIEW mv_customer_spend AS
+SELECT c.customer_id AS customer_id,
+       c.first_name || ' ' || c.last_name AS customer_name,
+       ROUND(SUM(p.product_unit_price * od.quantity_ordered), 2) AS total_spend
+FROM order_detail od
+JOIN customer c ON c.customer_id = od.customer_id
+JOIN product p ON p.product_id = od.product_id
+GROUP BY c.customer_id, c.first_name, c.last_name;
+CREATE UNIQUE INDEX ON mv_customer_spend (customer_id);
+CREATE INDEX ON mv_customer_spend (total_spend DESC);
+
+CREATE MATERIALIZED VIEW mv_monthly_sales AS
+SELECT DATE_TRUNC('month', od.order_date)::date AS month,
+       ROUND(SUM(p.product_unit_price * od.quantity_ordered), 2) AS total_revenue
+FROM order_detail od
+JOIN product p ON p.product_id = od.product_id
+GROUP BY month;
+CREATE UNIQUE INDEX ON mv_monthly_sales (month);
+
+CREATE MATERIALIZED VIEW mv_product_revenue AS
+SELECT p.product_id AS product_id,
+       p.product_name AS product_name,
+       ROUND(SUM(p.product_unit_price * od.quantity_ordered), 2) AS total_revenue
+FROM order_detail od
+JOIN product p ON p.product_id = od.product_id
+GROUP BY p.product_id, p.product_name;
+CREATE UNIQUE INDEX ON mv_product_revenue (product_id);
+CREATE INDEX ON mv_product_revenue (total_revenue DESC);
+
+CREATE MATERIALIZED VIEW mv_revenue_by_category AS
+SELECT pc.product_category AS product_category,
+       ROUND(SUM(p.product_unit_price * od.quantity_ordered), 2) AS total_revenue
+FROM order_detail od
+JOIN product p ON p.product_id = od.product_id
+JOIN product_category pc ON pc.product_category_id = p.product_category_id
+GROUP BY pc.product_category;
+CREATE UNIQUE INDEX ON mv_revenue_by_category (product_category);
+"""
+
+MATERIALIZED_VIEWS = [
+    "mv_revenue_by_region",
+    "mv_customer_spend",
+    "mv_monthly_sales",
+    "mv_product_revenue",
+    "mv_revenue_by_category",
+]
+
+# "Recent Orders" needs no view: this index turns its ORDER BY ... LIMIT 50 into an index scan
+POSTGRES_INDEXES_SQL = """
+CREATE INDEX order_detail_order_date_idx ON order_detail (order_date DESC, order_id DESC);
+"""
+
+
+# Orders span a few years, so distinct dates are few and the cache hit rate is ~100%
+@functools.lru_cache(maxsize=4096)
 def parse_sqlite_date(s):
     if s is None:
         return None
+    # fast path: the OrderDetail column is stored as YYYY-MM-DD text
+    if type(s) is str and len(s) == 10 and s[4] == "-" and s[7] == "-":
+        return datetime.date(int(s[0:4]), int(s[5:7]), int(s[8:10]))
     s = str(s).strip()
     if not s:
         return None
     if len(s) == 8 and s.isdigit():
-        return datetime.datetime.strptime(s, "%Y%m%d").date()
+        return datetime.date(int(s[0:4]), int(s[4:6]), int(s[6:8]))
     # expect YYYY-MM-DD
     return datetime.date.fromisoformat(s[:10])
 
 
+def order_detail_rows(rows):
+    # Batch transform, fused into one comprehension (no Python call per row besides the
+    # cached date parse). Only the date needs converting; COPY parses the integers itself
+    return [(a, b, c, parse_sqlite_date(d), e) for a, b, c, d, e in rows]
+
+
 def verify_sqlite_tables(sqlite_conn):
     cur = sqlite_conn.cursor()
     cur.execute("SELECT name FROM sqlite_master WHERE type='table';")
@@ -107,7 +237,51 @@ def verify_sqlite_tables(sqlite_conn):
         )
 
 
-def copy_table(sqlite_conn, pg_conn, sqlite_table, pg_table, sqlite_cols, pg_cols, transform=None, batch_size=50_000):
+def refresh_materialized_views(pg_conn):
+    # CONCURRENTLY keeps the views readable by the app while they rebuild
+    cur = pg_conn.cursor()
+    for view in MATERIALIZED_VIEWS:
+        print(f"Refreshing {view}...")
+        cur.execute(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {view};")
+        pg_conn.commit()
+    cur.close()
+
+
+COPY_NULL = "\\N"
+
+
+def _read_batches(rows, batch_size, transform, batches, stop):
+    # Producer: runs in its own thread so SQLite reads overlap Postgres writes.
+    # `stop` is set by the consumer when the load fails, so the rest of the table isn't read
+    try:
+        while not stop.is_set():
+            chunk = islice(rows, batch_size)
+            batch = transform(chunk) if transform else list(chunk)
+            if not batch:
+                break
+            batches.put(batch)
+    except Exception as e:
+        batches.put(e)
+    finally:
+        batches.put(None)
+
+
+def copy_table(sqlite_conn, pg_conn, sqlite_table, pg_table, sqlite_cols, pg_cols, transform=None, batch_size=50_000, use_copy=True):
+    # sqlite_conn must be opened with check_same_thread=False (read happens in a worker thread)
+    # transform, if given, maps an iterable of SQLite rows to a list of Postgres rows
+    # If the server rejects COPY, the table is rolled back and reloaded with a prepared INSERT
+    args = (sqlite_conn, pg_conn, sqlite_table, pg_table, sqlite_cols, pg_cols, transform, batch_size)
+    if use_copy:
+        try:
+            _load_table(*args, use_copy=True)
+            return
+        except (errors.InsufficientPrivilege, errors.FeatureNotSupported) as e:
+            pg_conn.rollback()
+            print(f"COPY rejected for {pg_table} ({str(e).strip()}); retrying with prepared INSERT")
+    _load_table(*args, use_copy=False)
+
+
+def _load_table(sqlite_conn, pg_conn, sqlite_table, pg_table, sqlite_cols, pg_cols, transform, batch_size, use_copy):
     s_cur = sqlite_conn.cursor()
     p_cur = pg_conn.cursor()
 
@@ -115,28 +289,74 @@ def copy_table(sqlite_conn, pg_conn, sqlite_table, pg_table, sqlite_cols, pg_col
     p_col_list = ", ".join(pg_cols)
 
     s_cur.execute(f"SELECT {s_col_list} FROM {sqlite_table};")
-    insert_sql = f"INSERT INTO {pg_table} ({p_col_list}) VALUES %s"
+    # Explicit NULL marker: in CSV an unquoted empty field would also turn '' into NULL
+    copy_sql = f"COPY {pg_table} ({p_col_list}) FROM STDIN WITH (FORMAT CSV, NULL '{COPY_NULL}')"
+
+    if not use_copy:
+        # Parse/plan the INSERT once per table; each row then only sends EXECUTE
+        stmt = f"insert_{pg_table}"
+        params = ", ".join(f"${i}" for i in range(1, len(pg_cols) + 1))
+        p_cur.execute(f"PREPARE {stmt} AS INSERT INTO {pg_table} ({p_col_list}) VALUES ({params});")
+        execute_sql = f"EXECUTE {stmt} ({', '.join(['%s'] * len(pg_cols))})"
+
+    # Bounded queue: at most two batches wait here while the reader builds the next one
+    batches = queue.Queue(maxsize=2)
+    stop = threading.Event()
+    reader = threading.Thread(target=_read_batches, args=(s_cur, batch_size, transform, batches, stop), daemon=True)
+    reader.start()
 
     total = 0
-    while True:
-        rows = s_cur.fetchmany(batch_size)
-        if not rows:
-            break
-
-        if transform:
-            rows = [transform(r) for r in rows]
-
-        extras.execute_values(p_cur, insert_sql, rows, page_size=10_000)
-        pg_conn.commit()
-        total += len(rows)
-        print(f"Inserted {total:,} rows into {pg_table}")
-
+    try:
+        while True:
+            batch = batches.get()
+            if batch is None:
+                break
+            if isinstance(batch, Exception):
+                raise batch
+
+            if use_copy:
+                # Stream the batch as CSV straight into COPY (None -> COPY_NULL, '' stays '')
+                buf = io.StringIO()
+                writer = csv.writer(buf)
+                writer.writerows(
+                    row if None not in row else tuple(COPY_NULL if v is None else v for v in row)
+                    for row in batch
+                )
+                buf.seek(0)
+                p_cur.copy_expert(copy_sql, buf)
+            else:
+                extras.execute_batch(p_cur, execute_sql, batch, page_size=1000)
+            total += len(batch)
+            print(f"Inserted {total:,} rows into {pg_table}")
+    finally:
+        # Stop the reader after its current batch, and drain so it is never left
+        # blocked on a full queue
+        stop.set()
+        while reader.is_alive():
+            try:
+                batches.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        reader.join()
+
+    if not use_copy:
+        p_cur.execute(f"DEALLOCATE {stmt};")
+
+    # One commit (and WAL flush) per table rather than per batch
+    pg_conn.commit()
     p_cur.close()
     s_cur.close()
 
 
 if __name__ == "__main__":
 
+    # `python populate_db.py --refresh-views` only refreshes the Quick Prompt views
+    # (e.g. from a cron job) without re-running the migration
+    if "--refresh-views" in sys.argv[1:]:
+        pg_conn = psycopg2.connect(get_db_url())
+        refresh_materialized_views(pg_conn)
+        pg_conn.close()
+        sys.exit(0)
 
     SQLITE_DB_PATH = "normalized.db"
 
@@ -147,7 +367,7 @@ if __name__ == "__main__":
     DATABASE_URL = get_db_url()
 
     # Connect to SQLite
-    sqlite_conn = sqlite3.connect(SQLITE_DB_PATH)
+    sqlite_conn = sqlite3.connect(SQLITE_DB_PATH, check_same_thread=False)
     sqlite_conn.execute("PRAGMA foreign_keys = ON;")
     verify_sqlite_tables(sqlite_conn)
 
@@ -163,6 +383,11 @@ if __name__ == "__main__":
 
     # Reconnect for migration
     pg_conn = psycopg2.connect(DATABASE_URL)
+    # One-shot load: a crash just means re-running the script, so don't wait on WAL flushes
+    cur = pg_conn.cursor()
+    cur.execute("SET synchronous_commit = off;")
+    pg_conn.commit()
+    cur.close()
 
     print("Migrating Region...")
     copy_table(
@@ -201,8 +426,8 @@ if __name__ == "__main__":
         sqlite_conn, pg_conn,
         "Product", "product",
         ["ProductID", "ProductName", "ProductUnitPrice", "ProductCategoryID"],
-        ["product_id", "product_name", "product_unit_price", "product_category_id"],
-        transform=lambda r: (r[0], r[1], round(float(r[2]), 2), r[3])
+        ["product_id", "product_name", "product_unit_price", "product_category_id"]
+        # no transform: Postgres rounds the price when casting to NUMERIC(12,2)
     )
 
     print("Migrating OrderDetail...")
@@ -211,9 +436,28 @@ if __name__ == "__main__":
         "OrderDetail", "order_detail",
         ["OrderID", "CustomerID", "ProductID", "OrderDate", "QuantityOrdered"],
         ["order_id", "customer_id", "product_id", "order_date", "quantity_ordered"],
-        transform=lambda r: (r[0], r[1], r[2], parse_sqlite_date(r[3]), int(r[4]))
+        transform=order_detail_rows
     )
 
+    # Tables must be LOGGED before FKs: a permanent table can't reference an unlogged one
+    print("Converting tables to LOGGED...")
+    cur = pg_conn.cursor()
+    cur.execute(POSTGRES_SET_LOGGED_SQL)
+    pg_conn.commit()
+
+    print("Adding foreign keys...")
+    cur.execute(POSTGRES_FOREIGN_KEYS_SQL)
+    pg_conn.commit()
+
+    print("Creating indexes...")
+    cur.execute(POSTGRES_INDEXES_SQL)
+    pg_conn.commit()
+
+    print("Creating materialized views...")
+    cur.execute(POSTGRES_MATERIALIZED_VIEWS_SQL)
+    pg_conn.commit()
+    cur.close()
+
     pg_conn.close()
     sqlite_conn.close()
 
@@ -1,15 +1,28 @@
-import re
+import threading
+import time
+from contextlib import contextmanager
+
 import streamlit as st
 import pandas as pd
-import psycopg2
+from psycopg2 import extensions, pool
 from google import genai
+from google.genai import types
 from dotenv import load_dotenv
 import bcrypt
+import sqlglot
+from sqlglot import exp
 
 load_dotenv()
 
 GEMINI_API_KEY = st.secrets["OPENAI_API_KEY"]
 HASHED_PASSWORD = st.secrets["HASHED_PASSWORD"].encode("utf-8")
+# Inputs outside this range are rejected before paying for bcrypt.checkpw.
+# The upper bound is bcrypt's own limit in bytes (newer bcrypt raises above it)
+MIN_PASSWORD_LENGTH = 4
+MAX_PASSWORD_BYTES = 72
+# Guardrails for the (LLM-generated or user-edited) SQL run by run_query
+MAX_RESULT_ROWS = 10_000
+QUERY_TIMEOUT = "10s"
 
 st.set_page_config(
     page_title="AI SQL Query Assistant",
@@ -75,74 +88,200 @@ IMPORTANT NOTES:
 - Use ROUND(..., 2) for currency-style totals
 """
 
+# Built once at import; sent as the system instruction so the schema isn't
+# f-string-formatted (or duplicated) into every request
+SQL_SYSTEM_INSTRUCTION = (
+    "You are a PostgreSQL expert who generates accurate SQL queries based on natural language questions. "
+    "Given the following database schema and a user's question, generate a valid PostgreSQL query.\n"
+    + DATABASE_SCHEMA
+    + """
+Requirements:
+1. Generate ONLY the SQL query that I can directly use. No other response.
+2. Use proper JOINs when needed (region/country/customer/product/product_category).
+3. Use appropriate aggregations (COUNT, AVG, SUM, etc.) when needed.
+4. Add LIMIT clauses for queries that might return many rows (default LIMIT 100).
+5. Use proper date/time functions for DATE columns (order_date).
+6. Make sure the query is syntactically correct for PostgreSQL.
+7. Add helpful column aliases using AS.
+8. For revenue/sales totals, use product_unit_price * quantity_ordered and ROUND(..., 2).
+"""
+)
+SQL_GENERATION_CONFIG = types.GenerateContentConfig(system_instruction=SQL_SYSTEM_INSTRUCTION)
+
+PROMPT_MAP = {
+    "Revenue by Region (Top 10)": "Show total revenue by region, highest first, limit 10.",
+    "Top Customers by Spend": "Who are the top 10 customers by total spend?",
+    "Monthly Sales Trend": "Show total revenue by month for all years.",
+    "Top Products by Revenue": "List the top 10 products by revenue.",
+    "Revenue by Category": "Show total revenue by product category.",
+    "Recent Orders": "Show the 50 most recent orders with customer and product details."
+}
+
+# Known-good SQL for the quick prompts, so they never need a Gemini call
+PRESET_SQL = {
+    "Revenue by Region (Top 10)": """SELECT r.region AS region,
+       ROUND(SUM(p.product_unit_price * od.quantity_ordered), 2) AS total_revenue
+FROM order_detail od
+JOIN product p ON p.product_id = od.product_id
+JOIN customer c ON c.customer_id = od.customer_id
+JOIN country co ON co.country_id = c.country_id
+JOIN region r ON r.region_id = co.region_id
+GROUP BY r.region
+ORDER BY total_revenue DESC
+LIMIT 10;""",
+    "Top Customers by Spend": """SELECT c.customer_id AS customer_id,
+       c.first_name || ' ' || c.last_name AS customer_name,
+       ROUND(SUM(p.product_unit_price * od.quantity_ordered), 2) AS total_spend
+FROM order_detail od
+JOIN customer c ON c.customer_id = od.customer_id
+JOIN product p ON p.product_id = od.product_id
+GROUP BY c.customer_id, c.first_name, c.last_name
+ORDER BY total_spend DESC
+LIMIT 10;""",
+    "Monthly Sales Trend": """SELECT DATE_TRUNC('month', od.order_date)::date AS month,
+       ROUND(SUM(p.product_unit_price * od.quantity_ordered), 2) AS total_revenue
+FROM order_detail od
+JOIN product p ON p.product_id = od.product_id
+GROUP BY month
+ORDER BY month;""",
+    "Top Products by Revenue": """SELECT p.product_id AS product_id,
+       p.product_name AS product_name,
+       ROUND(SUM(p.product_unit_price * od.quantity_ordered), 2) AS total_revenue
+FROM order_detail od
+JOIN product p ON p.product_id = od.product_id
+GROUP BY p.product_id, p.product_name
+ORDER BY total_revenue DESC
+LIMIT 10;""",
+    "Revenue by Category": """SELECT pc.product_category AS product_category,
+       ROUND(SUM(p.product_unit_price * od.quantity_ordered), 2) AS total_revenue
+FROM order_detail od
+JOIN product p ON p.product_id = od.product_id
+JOIN product_category pc ON pc.product_category_id = p.product_category_id
+GROUP BY pc.product_category
+ORDER BY total_revenue DESC;""",
+    "Recent Orders": """SELECT od.order_id AS order_id,
+       od.order_date AS order_date,
+       c.first_name || ' ' || c.last_name AS customer_name,
+       p.product_name AS product_name,
+       od.quantity_ordered AS quantity_ordered,
+       ROUND(p.product_unit_price * od.quantity_ordered, 2) AS line_total
+FROM order_detail od
+JOIN customer c ON c.customer_id = od.customer_id
+JOIN product p ON p.product_id = od.product_id
+ORDER BY od.order_date DESC, od.order_id DESC
+LIMIT 50;""",
+}
+
+# Faster versions reading the materialized views created by populate_db.py
+# (refresh: populate_db.py --refresh-views). Used only when those views exist;
+# "Recent Orders" is served by an order_detail index instead
+PRESET_VIEWS = [
+    "mv_revenue_by_region",
+    "mv_customer_spend",
+    "mv_monthly_sales",
+    "mv_product_revenue",
+    "mv_revenue_by_category",
+]
+PRESET_VIEW_SQL = {
+    "Revenue by Region (Top 10)": """SELECT region, total_revenue
+FROM mv_revenue_by_region
+ORDER BY total_revenue DESC
+LIMIT 10;""",
+    "Top Customers by Spend": """SELECT customer_id, customer_name, total_spend
+FROM mv_customer_spend
+ORDER BY total_spend DESC
+LIMIT 10;""",
+    "Monthly Sales Trend": """SELECT month, total_revenue
+FROM mv_monthly_sales
+ORDER BY month;""",
+    "Top Products by Revenue": """SELECT product_id, product_name, total_revenue
+FROM mv_product_revenue
+ORDER BY total_revenue DESC
+LIMIT 10;""",
+    "Revenue by Category": """SELECT product_category, total_revenue
+FROM mv_revenue_by_category
+ORDER BY total_revenue DESC;""",
+}
+
+
+def _normalize_question(question):
+    # Whitespace only: case can matter inside SQL literals ('London' vs 'london')
+    return " ".join(question.split())
+
+
+# Preset matching can ignore case; the generated-SQL cache key must not
+_PRESET_BY_QUESTION = {
+    _normalize_question(question).lower(): name for name, question in PROMPT_MAP.items()
+}
+
+
+_THEME_CSS = """
+<style>
+  .stApp {
+    background:
+      radial-gradient(1100px 520px at 14% 8%, rgba(120, 90, 255, .16), transparent 60%),
+      radial-gradient(900px 480px at 92% 18%, rgba(0, 200, 255, .14), transparent 55%),
+      linear-gradient(180deg, #0b1020 0%, #070b16 100%);
+  }
+
+  .block-container {
+    max-width: 1180px;
+    padding-top: 1.9rem;
+    padding-bottom: 2.6rem;
+    padding-left: 1.6rem;
+    padding-right: 1.6rem;
+  }
+
+  [data-testid="stSidebar"]{
+    background: linear-gradient(180deg, rgba(255,255,255,.06), rgba(255,255,255,.02));
+    border-right: 1px solid rgba(255,255,255,.10);
+  }
+
+  .hero {
+    margin-top: .45rem;
+    border: 1px solid rgba(255,255,255,.14);
+    border-radius: 22px;
+    background: linear-gradient(135deg, rgba(255,255,255,.10), rgba(255,255,255,.03));
+    padding: 18px 18px 14px 18px;
+    box-shadow: 0 24px 60px rgba(0,0,0,.35);
+  }
+
+  .stTextArea textarea, .stTextInput input {
+    background: rgba(255,255,255,.06) !important;
+    border: 1px solid rgba(255,255,255,.14) !important;
+    border-radius: 16px !important;
+  }
+
+  button[kind="primary"], button { border-radius: 999px !important; }
+
+  .stAlert { border-radius: 18px; border: 1px solid rgba(255,255,255,.12); }
+
+  [data-testid="stExpander"]{
+    border: 1px solid rgba(255,255,255,.10);
+    border-radius: 18px;
+    overflow: hidden;
+    background: rgba(255,255,255,.04);
+  }
+
+  div[data-testid="stMetric"]{
+    background: rgba(255,255,255,.05);
+    border: 1px solid rgba(255,255,255,.12);
+    border-radius: 18px;
+    padding: 14px 14px 10px 14px;
+  }
+
+  .stDataFrame { border-radius: 18px; overflow: hidden; border: 1px solid rgba(255,255,255,.10); }
+
+  hr { margin: 1.15rem 0; border-color: rgba(255,255,255,.12); }
+
+  #MainMenu {visibility: hidden;}
+  footer {visibility: hidden;}
+</style>
+"""
+
 
 def _inject_theme():
-    st.markdown(
-        """
-        <style>
-          .stApp {
-            background:
-              radial-gradient(1100px 520px at 14% 8%, rgba(120, 90, 255, .16), transparent 60%),
-              radial-gradient(900px 480px at 92% 18%, rgba(0, 200, 255, .14), transparent 55%),
-              linear-gradient(180deg, #0b1020 0%, #070b16 100%);
-          }
-
-          .block-container {
-            max-width: 1180px;
-            padding-top: 1.9rem;
-            padding-bottom: 2.6rem;
-            padding-left: 1.6rem;
-            padding-right: 1.6rem;
-          }
-
-          [data-testid="stSidebar"]{
-            background: linear-gradient(180deg, rgba(255,255,255,.06), rgba(255,255,255,.02));
-            border-right: 1px solid rgba(255,255,255,.10);
-          }
-
-          .hero {
-            margin-top: .45rem;
-            border: 1px solid rgba(255,255,255,.14);
-            border-radius: 22px;
-            background: linear-gradient(135deg, rgba(255,255,255,.10), rgba(255,255,255,.03));
-            padding: 18px 18px 14px 18px;
-            box-shadow: 0 24px 60px rgba(0,0,0,.35);
-          }
-
-          .stTextArea textarea, .stTextInput input {
-            background: rgba(255,255,255,.06) !important;
-            border: 1px solid rgba(255,255,255,.14) !important;
-            border-radius: 16px !important;
-          }
-
-          button[kind="primary"], button { border-radius: 999px !important; }
-
-          .stAlert { border-radius: 18px; border: 1px solid rgba(255,255,255,.12); }
-
-          [data-testid="stExpander"]{
-            border: 1px solid rgba(255,255,255,.10);
-            border-radius: 18px;
-            overflow: hidden;
-            background: rgba(255,255,255,.04);
-          }
-
-          div[data-testid="stMetric"]{
-            background: rgba(255,255,255,.05);
-            border: 1px solid rgba(255,255,255,.12);
-            border-radius: 18px;
-            padding: 14px 14px 10px 14px;
-          }
-
-          .stDataFrame { border-radius: 18px; overflow: hidden; border: 1px solid rgba(255,255,255,.10); }
-
-          hr { margin: 1.15rem 0; border-color: rgba(255,255,255,.12); }
-
-          #MainMenu {visibility: hidden;}
-          footer {visibility: hidden;}
-        </style>
-        """,
-        unsafe_allow_html=True,
-    )
+    st.markdown(_THEME_CSS, unsafe_allow_html=True)
 
 
 def _hero():
@@ -173,64 +312,78 @@ def _hero():
 
 
 def login_screen():
-    _inject_theme()
-    st.markdown("<div style='height:18px'></div>", unsafe_allow_html=True)
-
-    left, center, right = st.columns([2, 5, 2])
-    with center:
-        st.markdown(
-            """
-            <div class="hero">
-              <div style="display:flex;align-items:center;gap:10px;margin-bottom:8px;">
-                <div style="font-size:20px;">🔐</div>
-                <div style="font-size:20px;font-weight:750;">Secure Login</div>
-              </div>
-              <div style="color:rgba(255,255,255,.72);font-size:13px;">
-                Enter your password to access the assistant.
-              </div>
-            </div>
-            """,
-            unsafe_allow_html=True,
-        )
-        st.write("")
-
-        password = st.text_input("Password", type="password", key="login_password")
-        c1, c2 = st.columns(2)
-        with c1:
-            login_btn = st.button("🔓 Login", type="primary", use_container_width=True)
-        with c2:
-            st.button(
-                "🧹 Clear",
-                use_container_width=True,
-                on_click=lambda: st.session_state.update({"login_password": ""}),
+    # Rendered into a placeholder so a successful login can clear it and the
+    # main UI can be drawn in the same run, without an st.rerun() round-trip
+    login_slot = st.empty()
+    logged_in = False
+    with login_slot.container():
+        st.markdown("<div style='height:18px'></div>", unsafe_allow_html=True)
+
+        left, center, right = st.columns([2, 5, 2])
+        with center:
+            st.markdown(
+                """
+                <div class="hero">
+                  <div style="display:flex;align-items:center;gap:10px;margin-bottom:8px;">
+                    <div style="font-size:20px;">🔐</div>
+                    <div style="font-size:20px;font-weight:750;">Secure Login</div>
+                  </div>
+                  <div style="color:rgba(255,255,255,.72);font-size:13px;">
+                    Enter your password to access the assistant.
+                  </div>
+                </div>
+                """,
+                unsafe_allow_html=True,
+            )
+            st.write("")
+
+            password = st.text_input("Password", type="password", key="login_password")
+            c1, c2 = st.columns(2)
+            with c1:
+                login_btn = st.button("🔓 Login", type="primary", use_container_width=True)
+            with c2:
+                st.button(
+                    "🧹 Clear",
+                    use_container_width=True,
+                    on_click=lambda: st.session_state.update({"login_password": ""}),
+                )
+
+            if login_btn:
+                if not password or not password.strip():
+                    st.warning("⚠️ Please enter a password")
+                elif (
+                    len(password) < MIN_PASSWORD_LENGTH
+                    or len(password.encode("utf-8")) > MAX_PASSWORD_BYTES
+                ):
+                    st.error("❌ Incorrect password")
+                else:
+                    try:
+                        if bcrypt.checkpw(password.encode("utf-8"), HASHED_PASSWORD):
+                            # No login_password reset: the widget already exists in this run,
+                            # and its state is dropped once it stops being rendered
+                            st.session_state.logged_in = True
+                            logged_in = True
+                        else:
+                            st.error("❌ Incorrect password")
+                    except Exception as e:
+                        st.error(f"❌ Authentication error: {e}")
+
+            st.info(
+                """
+                **Security Notice**
+                - Passwords are protected using bcrypt hashing  
+                - Your session stays active until you logout or close the browser
+                """
             )
 
-        if login_btn:
-            if password:
-                try:
-                    if bcrypt.checkpw(password.encode("utf-8"), HASHED_PASSWORD):
-                        st.session_state.logged_in = True
-                        st.session_state.login_password = ""  # clear field
-                        st.rerun()  # ✅ important: rerun so login UI disappears
-                    else:
-                        st.error("❌ Incorrect password")
-                except Exception as e:
-                    st.error(f"❌ Authentication error: {e}")
-            else:
-                st.warning("⚠️ Please enter a password")
-
-        st.info(
-            """
-            **Security Notice**
-            - Passwords are protected using bcrypt hashing  
-            - Your session stays active until you logout or close the browser
-            """
-        )
+    if logged_in:
+        login_slot.empty()
+    return logged_in
 
 
 def require_login():
-    if "logged_in" not in st.session_state or not st.session_state.logged_in:
-        login_screen()
+    # Once logged in, reruns never reach login_screen (and bcrypt) again
+    if not st.session_state.get("logged_in", False) and not login_screen():
         st.stop()
 
 
@@ -245,125 +398,277 @@ def get_db_url():
 
 DATABASE_URL = get_db_url()
 
+# Decode NUMERIC straight to float instead of Decimal: results are only ever shown
+# rounded to 2dp, and float columns land in pandas as float64 rather than object
+DEC2FLOAT = extensions.new_type(
+    extensions.DECIMAL.values,
+    "DEC2FLOAT",
+    lambda value, cur: float(value) if value is not None else None,
+)
+extensions.register_type(DEC2FLOAT)
+
 
 @st.cache_resource
-def get_db_connection():
+def get_db_pool():
     try:
-        return psycopg2.connect(DATABASE_URL)
+        # keepalives let the server-side socket stay warm between reruns
+        return pool.ThreadedConnectionPool(
+            1, 8, DATABASE_URL, keepalives=1, keepalives_idle=30
+        )
     except Exception as e:
         st.error(f"Failed to connect to database: {e}")
         return None
 
 
+@contextmanager
+def get_db_connection():
+    db_pool = get_db_pool()
+    if db_pool is None:
+        yield None
+        return
+    try:
+        conn = db_pool.getconn()
+    except pool.PoolError as e:  # all connections checked out
+        st.error(f"Database is busy, please try again: {e}")
+        yield None
+        return
+    try:
+        yield conn
+    finally:
+        try:
+            conn.rollback()  # read-only usage; end the transaction before reuse
+        except Exception:
+            pass  # dead socket: conn.closed is now set and the pool drops it
+        db_pool.putconn(conn, close=bool(conn.closed))
+
+
+_READ_ONLY_STATEMENTS = (exp.Select, exp.With, exp.Union, exp.Intersect, exp.Except)
+_WRITE_EXPRESSIONS = (exp.Insert, exp.Update, exp.Delete, exp.Merge, exp.Create, exp.Drop, exp.Command)
+
+
+# User/LLM SQL must be exactly one read-only SELECT; returns it re-rendered from the AST
+def _single_select(sql):
+    try:
+        statements = sqlglot.parse(sql, read="postgres")
+    except sqlglot.errors.ParseError as e:
+        raise ValueError(f"Could not parse SQL: {str(e).splitlines()[0]}") from e
+    # A trailing `; -- comment` parses as an extra comment-only statement
+    statements = [s for s in statements if s is not None and not isinstance(s, exp.Semicolon)]
+    if len(statements) != 1:
+        raise ValueError("Only a single SQL statement can be run.")
+    statement = statements[0]
+    if not isinstance(statement, _READ_ONLY_STATEMENTS) or statement.find(*_WRITE_EXPRESSIONS):
+        raise ValueError("Only SELECT queries can be run.")
+    # Rendering from the AST (comments become /* */) keeps the wrapper below intact
+    return statement.sql(dialect="postgres")
+
+
 def run_query(sql):
-    conn = get_db_connection()
-    if conn is None:
-        return None
     try:
-        return pd.read_sql_query(sql, conn)
-    except Exception as e:
+        sql = _single_select(sql)
+    except ValueError as e:
         st.error(f"Error executing query: {e}")
         return None
+    # The row cap is applied server-side; the extra row tells us whether the
+    # result was truncated
+    capped_sql = f"SELECT * FROM (\n{sql}\n) AS _sub LIMIT {MAX_RESULT_ROWS + 1}"
+
+    with get_db_connection() as conn:
+        if conn is None:
+            return None
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SET TRANSACTION READ ONLY; "
+                    f"SET LOCAL statement_timeout = '{QUERY_TIMEOUT}';"
+                )
+                cur.execute(capped_sql)
+                cols = [d.name for d in cur.description]
+                data = cur.fetchall()
+        except Exception as e:
+            st.error(f"Error executing query: {e}")
+            return None
+
+    if len(data) > MAX_RESULT_ROWS:
+        data = data[:MAX_RESULT_ROWS]
+        st.warning(f"⚠️ Showing the first {MAX_RESULT_ROWS:,} rows only")
+    return pd.DataFrame(data, columns=cols)
+
+
+def _warm_up_client(client):
+    try:
+        client.models.list(config={"page_size": 1})
+    except Exception:
+        pass  # best effort; the real request will surface any error
 
 
 @st.cache_resource
 def get_openai_client():
-    return genai.Client(api_key=GEMINI_API_KEY)
+    client = genai.Client(api_key=GEMINI_API_KEY)
+    # Open the HTTPS connection in the background so the first SQL generation
+    # doesn't pay for the TLS handshake
+    threading.Thread(target=_warm_up_client, args=(client,), daemon=True).start()
+    return client
 
 
 def extract_sql_from_response(response_text):
-    return re.sub(r"^```sql\s*|\s*```$", "", response_text, flags=re.IGNORECASE | re.MULTILINE).strip()
+    # Strip a leading ```sql / ``` fence and a trailing ``` without a regex pass
+    t = response_text.strip()
+    if t[:6].lower() == "```sql":
+        t = t[6:]
+    elif t.startswith("```"):
+        t = t[3:]
+    if t.endswith("```"):
+        t = t[:-3]
+    return t.strip()
 
 
-def generate_sql_with_gpt(user_question):
-    client = get_openai_client()
-    prompt = f"""You are a PostgreSQL expert. Given the following database schema and a user's question, generate a valid PostgreSQL query.
+# Generated SQL is cached by question for SQL_CACHE_TTL seconds, shared across sessions.
+# This holds plain strings only: the streaming preview is drawn outside the cache
+SQL_CACHE_TTL = 3600
+SQL_CACHE_MAX_ENTRIES = 256
 
-{DATABASE_SCHEMA}
 
-User Question: {user_question}
+@st.cache_resource
+def _generated_sql_cache():
+    # Shared by every session thread, so all access goes through the lock
+    return threading.Lock(), {}  # question_key -> (created_at, sql), oldest first
+
+
+def _get_cached_sql(question_key):
+    lock, cache = _generated_sql_cache()
+    with lock:
+        entry = cache.get(question_key)
+    if entry is None or time.monotonic() - entry[0] > SQL_CACHE_TTL:
+        return None
+    return entry[1]
 
-Requirements:
-1. Generate ONLY the SQL query that I can directly use. No other response.
-2. Use proper JOINs when needed (region/country/customer/product/product_category).
-3. Use appropriate aggregations (COUNT, AVG, SUM, etc.) when needed.
-4. Add LIMIT clauses for queries that might return many rows (default LIMIT 100).
-5. Use proper date/time functions for DATE columns (order_date).
-6. Make sure the query is syntactically correct for PostgreSQL.
-7. Add helpful column aliases using AS.
-8. For revenue/sales totals, use product_unit_price * quantity_ordered and ROUND(..., 2).
 
-Generate the SQL query:"""
+def _put_cached_sql(question_key, sql):
+    lock, cache = _generated_sql_cache()
+    now = time.monotonic()
+    with lock:
+        # Re-inserting moves the key to the end, keeping the dict in insertion-time order
+        cache.pop(question_key, None)
+        if len(cache) >= SQL_CACHE_MAX_ENTRIES:
+            for key in [k for k, (created_at, _) in cache.items() if now - created_at > SQL_CACHE_TTL]:
+                del cache[key]
+        while len(cache) >= SQL_CACHE_MAX_ENTRIES:
+            del cache[next(iter(cache))]  # drop the oldest entry
+        cache[question_key] = (now, sql)
 
+
+def generate_sql_with_gpt(user_question):
+    question_key = _normalize_question(user_question)
+    preset = _PRESET_BY_QUESTION.get(question_key.lower())
+    if preset is not None:
+        if preset in PRESET_VIEW_SQL and preset_views_available():
+            return PRESET_VIEW_SQL[preset]
+        return PRESET_SQL[preset]
+    cached_sql = _get_cached_sql(question_key)
+    if cached_sql is not None:
+        return cached_sql
+
+    client = get_openai_client()
+    preview = st.empty()
     try:
-        response = client.models.generate_content(
+        # Stream so the SQL shows up as it is generated instead of after the full reply
+        stream = client.models.generate_content_stream(
             model="gemini-2.5-flash",
-            contents=f"You are a PostgreSQL expert who generates accurate SQL queries based on natural language questions. Generate the query for the following: {prompt}"
+            contents=f"User Question: {user_question}\n\nGenerate the SQL query:",
+            config=SQL_GENERATION_CONFIG,
         )
-        return extract_sql_from_response(response.text)
+        parts = []
+        for chunk in stream:
+            if chunk.text:
+                parts.append(chunk.text)
+                preview.code(extract_sql_from_response("".join(parts)), language="sql")
+        sql = extract_sql_from_response("".join(parts))
     except Exception as e:
         st.error(f"Error calling Gemini API: {e}")
         return None
-
-
-@st.cache_data(ttl=60)
+    finally:
+        preview.empty()  # the final SQL is rendered in the editor below
+
+    if sql:
+        _put_cached_sql(question_key, sql)
+    return sql
+
+
+# False on databases loaded before the views were added (re-run populate_db.py);
+# the presets then fall back to the plain join queries
+@st.cache_data(ttl=300, show_spinner=False)
+def preset_views_available():
+    with get_db_connection() as conn:
+        if conn is None:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT COUNT(to_regclass(v)) FROM unnest(%s::text[]) AS v;",
+                    (PRESET_VIEWS,),
+                )
+                return cur.fetchone()[0] == len(PRESET_VIEWS)
+        except Exception:
+            return False
+
+
+@st.cache_data(ttl=300)
 def fetch_metrics():
-    sql_orders = "SELECT COUNT(*) AS orders FROM order_detail;"
-    sql_customers = "SELECT COUNT(*) AS customers FROM customer;"
-    sql_products = "SELECT COUNT(*) AS products FROM product;"
-    sql_revenue = """
-        SELECT COALESCE(ROUND(SUM(p.product_unit_price * od.quantity_ordered), 2), 0) AS revenue
-        FROM order_detail od
-        JOIN product p ON p.product_id = od.product_id;
+    # One round-trip for all four dashboard numbers
+    sql = """
+        SELECT
+            (SELECT COUNT(*) FROM order_detail) AS orders,
+            (SELECT COUNT(*) FROM customer) AS customers,
+            (SELECT COUNT(*) FROM product) AS products,
+            (SELECT COALESCE(ROUND(SUM(p.product_unit_price * od.quantity_ordered), 2), 0)
+             FROM order_detail od
+             JOIN product p ON p.product_id = od.product_id) AS revenue;
     """
 
     out = {"orders": 0, "customers": 0, "products": 0, "revenue": 0.0}
 
-    odf = run_query(sql_orders)
-    cdf = run_query(sql_customers)
-    pdf = run_query(sql_products)
-    rdf = run_query(sql_revenue)
-
-    if odf is not None and not odf.empty:
-        out["orders"] = int(odf.iloc[0]["orders"])
-    if cdf is not None and not cdf.empty:
-        out["customers"] = int(cdf.iloc[0]["customers"])
-    if pdf is not None and not pdf.empty:
-        out["products"] = int(pdf.iloc[0]["products"])
-    if rdf is not None and not rdf.empty:
-        out["revenue"] = float(rdf.iloc[0]["revenue"])
+    with get_db_connection() as conn:
+        if conn is None:
+            return out
+        try:
+            with conn.cursor() as cur:
+                cur.execute(sql)
+                row = cur.fetchone()
+        except Exception as e:
+            st.error(f"Error executing query: {e}")
+            return out
+
+    if row is not None:
+        out["orders"] = int(row[0])
+        out["customers"] = int(row[1])
+        out["products"] = int(row[2])
+        out["revenue"] = float(row[3])
 
     return out
 
 
 def main():
-    require_login()
     _inject_theme()
+    get_openai_client()  # starts the warm-up while the login screen is shown
+    require_login()
+    main_content()
 
-    if "query_history" not in st.session_state:
-        st.session_state.query_history = []
-    if "generated_sql" not in st.session_state:
-        st.session_state.generated_sql = None
-    if "current_question" not in st.session_state:
-        st.session_state.current_question = None
-    if "question_text" not in st.session_state:
-        st.session_state.question_text = ""
-    if "selected_prompt" not in st.session_state:
-        st.session_state.selected_prompt = "Top Customers by Spend"
-
-    prompt_map = {
-        "Revenue by Region (Top 10)": "Show total revenue by region, highest first, limit 10.",
-        "Top Customers by Spend": "Who are the top 10 customers by total spend?",
-        "Monthly Sales Trend": "Show total revenue by month for all years.",
-        "Top Products by Revenue": "List the top 10 products by revenue.",
-        "Revenue by Category": "Show total revenue by product category.",
-        "Recent Orders": "Show the 50 most recent orders with customer and product details."
-    }
+
+def main_content():
+    for key, default in (
+        ("query_history", []),
+        ("generated_sql", None),
+        ("current_question", None),
+        ("question_text", ""),
+        ("selected_prompt", "Top Customers by Spend"),
+    ):
+        st.session_state.setdefault(key, default)
 
     st.sidebar.markdown("## 🧭 Quick Prompts")
     st.sidebar.caption("Pick a prompt, then click **Apply**.")
     with st.sidebar.form("prompt_form", border=False):
-        st.selectbox("Choose a prompt", list(prompt_map.keys()), key="selected_prompt")
+        st.selectbox("Choose a prompt", list(PROMPT_MAP.keys()), key="selected_prompt")
         col1, col2 = st.columns(2)
         with col1:
             apply_clicked = st.form_submit_button("🪄 Apply", type="primary", use_container_width=True)
@@ -371,7 +676,7 @@ def main():
             clear_clicked = st.form_submit_button("🧹 Clear", use_container_width=True)
 
     if apply_clicked:
-        st.session_state.question_text = prompt_map[st.session_state.selected_prompt]
+        st.session_state.question_text = PROMPT_MAP[st.session_state.selected_prompt]
         st.session_state.generated_sql = None
         st.session_state.current_question = None
 